@@ -10,8 +10,10 @@
 
 #include "config.h"
 
+#include <glib-unix.h>
 #include <locale.h>
 #include <polkit/polkit.h>
+#include <signal.h>
 
 #include "power-profiles-daemon-resources.h"
 #include "power-profiles-daemon.h"
@@ -919,6 +921,20 @@ restart_profile_drivers (void)
   start_profile_drivers (ppd_app);
 }
 
+static gboolean
+sighup_cb (gpointer user_data)
+{
+  PpdApp *data = user_data;
+
+  if (!data->was_started)
+    return G_SOURCE_CONTINUE;
+
+  g_debug ("Received SIGHUP, probing drivers again");
+  restart_profile_drivers ();
+
+  return G_SOURCE_CONTINUE;
+}
+
 static void
 name_acquired_handler (GDBusConnection *connection,
                        const gchar     *name,
@@ -1035,6 +1051,9 @@ int main (int argc, char **argv)
   /* Set up D-Bus */
   setup_dbus (data, replace);
 
+  /* Re-probe drivers on SIGHUP */
+  g_unix_signal_add (SIGHUP, sighup_cb, data);
+
   g_main_loop_run (data->main_loop);
   ret = data->ret;
   free_app_data (data);